@@ -3,20 +3,53 @@ Filters for preprocessing lingual ultrasound data for dimensionality reduction.
   TODO: include generalized dimensionality reduction utilities here.
 '''
 
+import cv2
 import numpy as np
 
-from scipy.ndimage import median_filter
+from numba import cuda, float32, float64, njit, prange
 from scipy.ndimage.filters import gaussian_laplace
 
-def normalize(frame):
+def normalize(frame, out=None, jit=False):
     """
     Normalize input image to range 0,1 and cast to float.
+      out: optional float array of the same shape to write the result into.
+      jit: if True, find the range and rescale in the compiled
+        _normalize_kernel instead of with NumPy reductions.
     """
-    mx = float(np.amax(frame))
+    if out is None:
+        out = np.empty(frame.shape, dtype=np.float64)
+
+    if jit:
+        _normalize_kernel(frame, out)
+        return out
+
     mn = float(np.amin(frame))
-    norm = (frame-mn)/(mx-mn)
+    rng = float(np.ptp(frame))
+    np.subtract(frame, mn, out=out)
+    out /= rng
+
+    return out
+
+@njit(parallel=True, cache=True)
+def _normalize_kernel(frame, out):
+    """
+    Min-max normalization of frame into out: one reduction pass for
+      both extrema, one pass to rescale.
+    """
+    M,N = frame.shape
 
-    return norm
+    mn = np.inf
+    mx = -np.inf
+    for i in prange(M):
+        for j in range(N):
+            val = float(frame[i,j])
+            mn = min(mn, val)
+            mx = max(mx, val)
+
+    rng = mx - mn
+    for i in prange(M):
+        for j in range(N):
+            out[i,j] = (frame[i,j] - mn) / rng
 
 def norm_check(frame):
     """
@@ -25,11 +58,12 @@ def norm_check(frame):
     if not np.issubdtype(frame.dtype, np.floating):
         raise TypeError("Input data must be float arrays")
 
-    if not (frame >= 0.).all() and (frame <= 1.).all():
+    # written so that NaN extrema also fail
+    if not (frame.min() >= 0. and frame.max() <= 1.):
         raise ValueError("Input data must be normalized to range 0,1")
 
 
-def srad(frame, n_iter=300, lbda=0.05):
+def srad(frame, n_iter=300, lbda=0.05, jit=True):
     '''
     Speckle-reducing anisotropic diffusion filter to reduce noise
       typical of ultrasound images. Derived from MATLAB code in  
@@ -43,72 +77,524 @@ def srad(frame, n_iter=300, lbda=0.05):
     Inputs: frame, an ultrasound frame
       n_iter: number of iterations (Y&A use 300)
       lbda: lambda, AKA delta-t in Y&A (who use 0.05)
-    Outputs: J, filtered ultrasound frame.
+      jit: if True (default), run the iterations in the compiled
+        kernel _srad_kernel; if False, use the NumPy implementation.
+    Outputs: J, filtered ultrasound frame (float64). Iterations are
+      carried out in single precision.
     '''
 
     # checks on I for number/type
     # TODO
 
-    # scale to [0,1]
-    I = normalize(frame)
-
-    # get image size
-    M,N = I.shape
-
-    # image indices, using boundary conditions 
-    iN = np.concatenate((np.arange(0, 1), np.arange(0, M-1)), axis=0)
-    iS = np.concatenate((np.arange(1, M), np.arange(M-1, M)), axis=0) 
-    jW = np.concatenate((np.arange(0, 1), np.arange(0, N-1)), axis=0)
-    jE = np.concatenate((np.arange(1, N), np.arange(N-1, N)), axis=0)
+    # scale to [0,1], working in single precision
+    I = normalize(frame, out=np.empty(frame.shape, dtype=np.float32), jit=jit)
 
     # log uncompress
-    I = np.exp(I)
+    np.exp(I, out=I)
 
     # the algorithm itself
+    if jit:
+        I = _srad_kernel(I, n_iter, lbda, np.float32(np.spacing(1)))
+    else:
+        I = _srad_numpy(I, n_iter, lbda)
+
+    # log (re)compress
+    J = np.log(I).astype(np.float64)
+
+    return J
+
+def _srad_numpy(I, n_iter, lbda):
+    '''
+    SRAD iterations as whole-array NumPy expressions. Reference
+      implementation for _srad_kernel; see srad for inputs.
+    '''
+
+    I = I.copy()
+    eps = I.dtype.type(np.spacing(1))
+
+    # neighbor differences and coefficients, reused across iterations;
+    #   boundary rows/columns difference with themselves (zero)
+    dN = np.zeros_like(I)
+    dS = np.zeros_like(I)
+    dW = np.zeros_like(I)
+    dE = np.zeros_like(I)
+    cS = np.empty_like(I)
+    cE = np.empty_like(I)
+
+    # scratch arrays for the remaining per-iteration terms
+    G2 = np.empty_like(I)
+    L = np.empty_like(I)
+    q_squared = np.empty_like(I)
+    den = np.empty_like(I)
+    c = np.empty_like(I)
+    D = np.empty_like(I)
+    tmp = np.empty_like(I)
+
     for n in range(0,n_iter):
 
         # speckle scale fcn
         # IC = I.copy()
         # Iuniform = IC.crop(rect)
-        q0_squared = np.var(I) / (np.mean(I)**2)
+        q0_squared = _q0_squared(I)
 
         # differences, element-by-element along each row moving from given direction (N, S, E, W)
-        dN = I[iN,:] - I
-        dS = I[iS,:] - I
-        dW = I[:,jW] - I
-        dE = I[:,jE] - I
+        np.subtract(I[:-1,:], I[1:,:], out=dN[1:,:])
+        np.subtract(I[1:,:], I[:-1,:], out=dS[:-1,:])
+        np.subtract(I[:,:-1], I[:,1:], out=dW[:,1:])
+        np.subtract(I[:,1:], I[:,:-1], out=dE[:,:-1])
 
         # normalized discrete gradient magnitude squared (Yu and Acton eqn. 52, 53)
-        G2 = (dN**2 + dS**2 + dW**2 + dE**2) / I**2
+        np.multiply(dN, dN, out=G2)
+        for d in (dS, dW, dE):
+            np.multiply(d, d, out=tmp)
+            G2 += tmp
+        np.multiply(I, I, out=tmp)
+        G2 /= tmp
 
         # normalized discrete Laplacian (eqn. 54)
-        L = (dN + dS + dW + dE) / I
+        np.add(dN, dS, out=L)
+        L += dW
+        L += dE
+        L /= I
 
         # instantaneous coefficient of variation (ICOV) (eqns. 31/35)
-        num = (.5*G2) - ((1/16)*(L**2))
-        den = (1. + ((.25)*L))**2
-        q_squared = num / (den + np.spacing(1))
+        np.multiply(G2, .5, out=q_squared)
+        np.multiply(L, L, out=tmp)
+        tmp *= (1/16)
+        q_squared -= tmp
+        np.multiply(L, .25, out=den)
+        den += 1.
+        den *= den
+        den += eps
+        q_squared /= den
 
         # diffusion coefficient (eqn. 33) # TODO why is this also "den"?
-        den = (q_squared - q0_squared) / (q0_squared * (q0_squared + 1) + np.spacing(1))
-        c = 1 / (den + 1)
+        np.subtract(q_squared, q0_squared, out=den)
+        den /= (q0_squared * (q0_squared + 1) + eps)
+        den += 1
+        np.divide(1, den, out=c)
 
-        # saturate diffusion coefficient 
-        c = np.where(c>0, 1, 0)
+        # saturate diffusion coefficient to [0,1]
+        np.clip(c, 0., 1., out=c)
 
         # divergence (eqn. 58)
-        cS = c[iS,:] 
-        cE = c[:,jE] 
-        D = (c * dN) + (cS * dS) + (c * dW) + (cE * dE)
+        cS[:-1,:] = c[1:,:]
+        cS[-1,:] = c[-1,:]
+        cE[:,:-1] = c[:,1:]
+        cE[:,-1] = c[:,-1]
+        np.multiply(c, dN, out=D)
+        np.multiply(cS, dS, out=tmp)
+        D += tmp
+        np.multiply(c, dW, out=tmp)
+        D += tmp
+        np.multiply(cE, dE, out=tmp)
+        D += tmp
 
         # SRAD update fcn (eqn. 61)
-        I = I + (lbda/4) * D
+        D *= (lbda/4)
+        I += D
+
+    return I
+
+def _q0_squared(I):
+    '''
+    Speckle scale var(I) / mean(I)**2 from one sum and one dot product
+      (sum of squares) over I, rather than separate np.var and np.mean
+      passes. Returned in the dtype of I.
+    '''
+    n_px = I.size
+    flat = I.ravel()
+    mu = float(flat.sum()) / n_px
+    sumsq = float(np.dot(flat, flat))
+
+    return I.dtype.type((sumsq / n_px - mu * mu) / (mu * mu))
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _srad_kernel(I, n_iter, lbda, eps):
+    '''
+    SRAD iterations as a compiled stencil: each iteration makes one
+      pass for the speckle scale, one for the diffusion coefficient
+      and one for the divergence/update, with neighbor indices clamped
+      inline rather than gathered through index arrays. Equivalent to
+      _srad_numpy; see srad for inputs. eps is added to denominators.
+      Per-pixel arithmetic is kept in float32 (I should be float32);
+      the speckle scale sums are accumulated in float64.
+    '''
+
+    M,N = I.shape
+    n_px = M * N
+    half = np.float32(.5)
+    sixteenth = np.float32(1/16)
+    quarter = np.float32(.25)
+    zero = np.float32(0.)
+    one = np.float32(1.)
+    step = np.float32(lbda/4)
+
+    I_cur = I.copy()
+    I_next = np.empty_like(I)
+    c_arr = np.empty_like(I)
+
+    for n in range(n_iter):
+
+        # speckle scale fcn, from a single sum/sum-of-squares pass
+        s = 0.
+        s2 = 0.
+        for i in prange(M):
+            for j in range(N):
+                val = I_cur[i,j]
+                s += val
+                s2 += val * val
+        mu = s / n_px
+        q0_squared = np.float32((s2 / n_px - mu * mu) / (mu * mu))
+
+        # diffusion coefficient (eqns. 31-35, 52-54)
+        for i in prange(M):
+            iN = max(i-1, 0)
+            iS = min(i+1, M-1)
+            for j in range(N):
+                jW = max(j-1, 0)
+                jE = min(j+1, N-1)
+                Ic = I_cur[i,j]
+                dN = I_cur[iN,j] - Ic
+                dS = I_cur[iS,j] - Ic
+                dW = I_cur[i,jW] - Ic
+                dE = I_cur[i,jE] - Ic
+
+                G2 = (dN*dN + dS*dS + dW*dW + dE*dE) / (Ic*Ic)
+                L = (dN + dS + dW + dE) / Ic
+
+                num = (half*G2) - (sixteenth*(L*L))
+                den = (one + (quarter*L))
+                den = den * den
+                q_squared = num / (den + eps)
+
+                den = (q_squared - q0_squared) / (q0_squared * (q0_squared + one) + eps)
+                c = one / (den + one)
+
+                # saturate diffusion coefficient to [0,1]
+                c_arr[i,j] = min(max(c, zero), one)
+
+        # divergence (eqn. 58) and SRAD update fcn (eqn. 61)
+        for i in prange(M):
+            iN = max(i-1, 0)
+            iS = min(i+1, M-1)
+            for j in range(N):
+                jW = max(j-1, 0)
+                jE = min(j+1, N-1)
+                Ic = I_cur[i,j]
+                c = c_arr[i,j]
+                D = (c * (I_cur[iN,j] - Ic)) + (c_arr[iS,j] * (I_cur[iS,j] - Ic)) \
+                    + (c * (I_cur[i,jW] - Ic)) + (c_arr[i,jE] * (I_cur[i,jE] - Ic))
+                I_next[i,j] = Ic + step * D
+
+        I_cur, I_next = I_next, I_cur
+
+    return I_cur
+
+def srad_gpu(frame, n_iter=300, lbda=0.05):
+    '''
+    GPU version of srad, using Numba CUDA kernels. The frame is copied
+      to the device once, all iterations run there, and only the
+      filtered frame is copied back. Requires a CUDA-capable GPU.
+
+    Inputs and outputs as for srad.
+    '''
+
+    # scale to [0,1], working in single precision
+    I = normalize(frame, out=np.empty(frame.shape, dtype=np.float32))
+
+    # log uncompress
+    np.exp(I, out=I)
+
+    M,N = I.shape
+    threads = (_GPU_TPB, _GPU_TPB)
+    blocks = ((N + _GPU_TPB - 1) // _GPU_TPB, (M + _GPU_TPB - 1) // _GPU_TPB)
+    eps = np.float32(np.spacing(1))
+    step = np.float32(lbda/4)
+
+    I_cur = cuda.to_device(I)
+    I_next = cuda.device_array_like(I_cur)
+    c_arr = cuda.device_array_like(I_cur)
+    sums = cuda.device_array(2, dtype=np.float64)
+    zeros = np.zeros(2, dtype=np.float64)
+
+    # the algorithm itself
+    for n in range(0,n_iter):
+        sums.copy_to_device(zeros)
+        _srad_gpu_sums[blocks, threads](I_cur, sums)
+        _srad_gpu_coeff[blocks, threads](I_cur, sums, eps, c_arr)
+        _srad_gpu_update[blocks, threads](I_cur, c_arr, step, I_next)
+        I_cur, I_next = I_next, I_cur
 
     # log (re)compress
-    J = np.log(I) 
+    J = np.log(I_cur.copy_to_host()).astype(np.float64)
 
     return J
 
+# CUDA thread block width; kernels run on _GPU_TPB x _GPU_TPB blocks
+_GPU_TPB = 16
+
+@cuda.jit
+def _srad_gpu_sums(I, sums):
+    '''
+    Accumulate the sum and sum of squares of I into sums[0] and sums[1],
+      reducing within each block in shared memory first.
+    '''
+    s = cuda.shared.array(_GPU_TPB * _GPU_TPB, dtype=float64)
+    s2 = cuda.shared.array(_GPU_TPB * _GPU_TPB, dtype=float64)
+
+    M,N = I.shape
+    tid = cuda.threadIdx.y * _GPU_TPB + cuda.threadIdx.x
+    i = cuda.blockIdx.y * _GPU_TPB + cuda.threadIdx.y
+    j = cuda.blockIdx.x * _GPU_TPB + cuda.threadIdx.x
+
+    val = 0.
+    if i < M and j < N:
+        val = float64(I[i,j])
+    s[tid] = val
+    s2[tid] = val * val
+    cuda.syncthreads()
+
+    stride = (_GPU_TPB * _GPU_TPB) // 2
+    while stride > 0:
+        if tid < stride:
+            s[tid] += s[tid + stride]
+            s2[tid] += s2[tid + stride]
+        cuda.syncthreads()
+        stride //= 2
+
+    if tid == 0:
+        cuda.atomic.add(sums, 0, s[0])
+        cuda.atomic.add(sums, 1, s2[0])
+
+@cuda.jit
+def _srad_gpu_coeff(I, sums, eps, c_arr):
+    '''
+    Saturated diffusion coefficient of each pixel (see _srad_kernel),
+      reading I through a shared-memory tile with a one-pixel halo.
+    '''
+    tile = cuda.shared.array((_GPU_TPB + 2, _GPU_TPB + 2), dtype=float32)
+
+    M,N = I.shape
+    i0 = cuda.blockIdx.y * _GPU_TPB
+    j0 = cuda.blockIdx.x * _GPU_TPB
+    ti = cuda.threadIdx.y
+    tj = cuda.threadIdx.x
+
+    # fill the tile, clamping the halo at the image boundaries
+    for k in range(ti * _GPU_TPB + tj, (_GPU_TPB + 2) * (_GPU_TPB + 2), _GPU_TPB * _GPU_TPB):
+        ki = k // (_GPU_TPB + 2)
+        kj = k % (_GPU_TPB + 2)
+        tile[ki, kj] = I[min(max(i0 + ki - 1, 0), M - 1), min(max(j0 + kj - 1, 0), N - 1)]
+    cuda.syncthreads()
+
+    i = i0 + ti
+    j = j0 + tj
+    if i >= M or j >= N:
+        return
+
+    # speckle scale fcn
+    n_px = M * N
+    mu = sums[0] / n_px
+    q0_squared = float32((sums[1] / n_px - mu * mu) / (mu * mu))
+
+    Ic = tile[ti + 1, tj + 1]
+    dN = tile[ti, tj + 1] - Ic
+    dS = tile[ti + 2, tj + 1] - Ic
+    dW = tile[ti + 1, tj] - Ic
+    dE = tile[ti + 1, tj + 2] - Ic
+
+    G2 = (dN*dN + dS*dS + dW*dW + dE*dE) / (Ic*Ic)
+    L = (dN + dS + dW + dE) / Ic
+
+    num = (float32(.5)*G2) - (float32(1/16)*(L*L))
+    den = (float32(1.) + (float32(.25)*L))
+    den = den * den
+    q_squared = num / (den + eps)
+
+    den = (q_squared - q0_squared) / (q0_squared * (q0_squared + float32(1.)) + eps)
+    c = float32(1.) / (den + float32(1.))
+
+    # saturate diffusion coefficient to [0,1]
+    c_arr[i,j] = min(max(c, float32(0.)), float32(1.))
+
+@cuda.jit
+def _srad_gpu_update(I_cur, c_arr, step, I_next):
+    '''
+    Divergence (eqn. 58) and SRAD update fcn (eqn. 61) for one pixel.
+    '''
+    M,N = I_cur.shape
+    i = cuda.blockIdx.y * _GPU_TPB + cuda.threadIdx.y
+    j = cuda.blockIdx.x * _GPU_TPB + cuda.threadIdx.x
+    if i >= M or j >= N:
+        return
+
+    iN = max(i-1, 0)
+    iS = min(i+1, M-1)
+    jW = max(j-1, 0)
+    jE = min(j+1, N-1)
+    Ic = I_cur[i,j]
+    c = c_arr[i,j]
+    D = (c * (I_cur[iN,j] - Ic)) + (c_arr[iS,j] * (I_cur[iS,j] - Ic)) \
+        + (c * (I_cur[i,jW] - Ic)) + (c_arr[i,jE] * (I_cur[i,jE] - Ic))
+    I_next[i,j] = Ic + step * D
+
+def fast_median(frame, size):
+    """
+    Median filter over a size x size window; a drop-in replacement for
+      scipy.ndimage.median_filter(frame, size) whose cost grows linearly
+      rather than quadratically with window size.
+    8-bit frames with odd size are passed to cv2.medianBlur, which uses a
+      histogram median but replicates edge pixels instead of reflecting them.
+      All other frames go through _huang_median, which matches ndimage exactly.
+
+    Inputs: frame, a 2D ndarray; size, the window width in pixels
+    Output: filtered, ndarray of the same shape and dtype as frame
+    """
+    if frame.dtype == np.uint8 and size % 2 == 1:
+        return cv2.medianBlur(np.ascontiguousarray(frame), size)
+
+    filtered = np.empty_like(frame)
+    _huang_median(frame, size, filtered)
+
+    return filtered
+
+@njit(cache=True)
+def _reflect(x, n):
+    """
+    Index x into range(n) with ndimage's "reflect" boundary (d c b a | a b c d).
+    """
+    x = x % (2 * n)
+    if x >= n:
+        x = 2 * n - 1 - x
+    return x
+
+@njit(cache=True)
+def _median_level(fine, coarse, k, shift):
+    """
+    Return the k-th smallest level held in a two-tier histogram.
+    """
+    acc = 0
+    cb = 0
+    while acc + coarse[cb] <= k:
+        acc += coarse[cb]
+        cb += 1
+    lv = cb << shift
+    while acc + fine[lv] <= k:
+        acc += fine[lv]
+        lv += 1
+    return lv
+
+@njit(cache=True)
+def _rank_levels(frame):
+    """
+    Replace the pixels of frame by their ranks. Returns the rank image,
+      the sorted pixel values the ranks index into, and the bit shift
+      mapping ranks onto about sqrt(frame.size) coarse bins.
+    """
+    M,N = frame.shape
+    n_levels = M * N
+
+    flat = frame.ravel()
+    order = np.argsort(flat, kind='mergesort')
+    values = flat[order]
+    ranks = np.empty(n_levels, dtype=np.int64)
+    ranks[order] = np.arange(n_levels)
+
+    shift = 0
+    while (1 << (2 * shift)) < n_levels:
+        shift += 1
+
+    return ranks.reshape((M, N)), values, shift
+
+@njit(cache=True)
+def _huang_rows(levels, values, shift, size, i0, i1, out):
+    """
+    Sliding-histogram (Huang) median filter of rows i0:i1 into out, given
+      the output of _rank_levels. Each step right along a row removes the
+      leftmost window column from the histogram and adds the new rightmost
+      one; the median is located through the coarse and fine bins.
+      Window placement, rank and boundary follow ndimage.median_filter.
+    """
+    M,N = levels.shape
+    n_levels = values.size
+    fine = np.zeros(n_levels, dtype=np.int32)
+    coarse = np.zeros((n_levels >> shift) + 1, dtype=np.int32)
+
+    lo = size // 2
+    hi = size - lo - 1
+    k = (size * size) // 2
+
+    for i in range(i0, i1):
+
+        # window at the start of the row
+        for di in range(-lo, hi + 1):
+            ii = _reflect(i + di, M)
+            for dj in range(-lo, hi + 1):
+                lv = levels[ii, _reflect(dj, N)]
+                fine[lv] += 1
+                coarse[lv >> shift] += 1
+        out[i,0] = values[_median_level(fine, coarse, k, shift)]
+
+        # slide right one column at a time
+        for j in range(1, N):
+            j_out = _reflect(j - lo - 1, N)
+            j_in = _reflect(j + hi, N)
+            for di in range(-lo, hi + 1):
+                ii = _reflect(i + di, M)
+                lv = levels[ii, j_out]
+                fine[lv] -= 1
+                coarse[lv >> shift] -= 1
+                lv = levels[ii, j_in]
+                fine[lv] += 1
+                coarse[lv >> shift] += 1
+            out[i,j] = values[_median_level(fine, coarse, k, shift)]
+
+        # empty the histogram for the next row
+        for di in range(-lo, hi + 1):
+            ii = _reflect(i + di, M)
+            for dj in range(N - 1 - lo, N + hi):
+                lv = levels[ii, _reflect(dj, N)]
+                fine[lv] -= 1
+                coarse[lv >> shift] -= 1
+
+@njit(parallel=True, cache=True)
+def _huang_median(frame, size, out, rows_per_block=16):
+    """
+    Median filter of one frame into out, in parallel over blocks of rows.
+    """
+    M = frame.shape[0]
+    levels, values, shift = _rank_levels(frame)
+
+    n_blocks = (M + rows_per_block - 1) // rows_per_block
+    for b in prange(n_blocks):
+        i0 = b * rows_per_block
+        _huang_rows(levels, values, shift, size, i0, min(i0 + rows_per_block, M), out)
+
+@njit(parallel=True, cache=True)
+def _huang_median_batch(frames, size, out):
+    """
+    Median filter of a stack of frames into out, in parallel over frames.
+    """
+    for f in prange(frames.shape[0]):
+        levels, values, shift = _rank_levels(frames[f])
+        _huang_rows(levels, values, shift, size, 0, frames.shape[1], out[f])
+
+def batch_median(frames, size):
+    """
+    Median filter each frame in a stack over a size x size window, filtering
+      frames in parallel. Output matches scipy.ndimage.median_filter(frame, size)
+      applied to every frame in turn.
+
+    Inputs: frames, a 3D ndarray of frames stacked along the first axis;
+      size, the window width in pixels
+    Output: filtered, ndarray of the same shape and dtype as frames
+    """
+    filtered = np.empty_like(frames)
+    _huang_median_batch(frames, size, filtered)
+
+    return filtered
+
 def clean_frame(frame, median_radius=6, log_sigma=4):
     """
     Cleanup function to be run on SRAD output. Median filter for
@@ -128,17 +614,27 @@ def clean_frame(frame, median_radius=6, log_sigma=4):
     norm_check(frame)
 
     # median filter
-    cleaned = median_filter(frame, median_radius)
+    cleaned = fast_median(frame, median_radius)
 
     # add LoG, protecting against overflow
     logmask = gaussian_laplace(cleaned, log_sigma)
     frame_ceil = np.finfo(frame.dtype).max
-    logmask = frame_ceil - logmask
-    np.putmask(cleaned, logmask < cleaned, logmask)
-    cleaned += frame_ceil - logmask
+    _add_log_mask(cleaned, logmask, frame_ceil)
     
     return cleaned
 
+@njit(parallel=True, cache=True)
+def _add_log_mask(cleaned, logmask, frame_ceil):
+    """
+    Add logmask to cleaned in place in a single pass, first capping each
+      pixel at frame_ceil - logmask so the sum cannot overflow.
+    """
+    for i in prange(cleaned.shape[0]):
+        for j in range(cleaned.shape[1]):
+            lm = frame_ceil - logmask[i,j]
+            c = cleaned[i,j]
+            cleaned[i,j] = (lm if lm < c else c) + logmask[i,j]
+
 def noise_mask(frame):
     """
     TODO - expects normed, but before SRAD
@@ -158,7 +654,7 @@ def noise_mask(frame):
 
     return noised
 
-def roi(frame, lower, upper, left, right):
+def roi(frame, lower, upper, left, right, out=None):
     """
     Defines region of interest along ultrasound scan lines; returns
       boolean array in which 1 indicates an area inside the RoI
@@ -169,6 +665,8 @@ def roi(frame, lower, upper, left, right):
       lower: bound of RoI further away from probe 
       upper: bound of RoI closer to probe
       left:
+      out: optional ndarray of the same shape as frame to write the mask
+        into, e.g. when masking many frames in a loop
 
     Outputs:
       mask: ndarray of same shape as frame containing mask
@@ -180,8 +678,13 @@ def roi(frame, lower, upper, left, right):
     if left >= right:
         raise ValueError("ROI left bound must be smaller than right bound")
 
-    mask = np.zeros(frame.shape, dtype=frame.dtype)
+    # every element is written exactly once: the RoI, then the bands around it
+    mask = np.empty_like(frame) if out is None else out
     mask[lower:upper,left:right] = 1
+    mask[:lower,:] = 0
+    mask[upper:,:] = 0
+    mask[lower:upper,:left] = 0
+    mask[lower:upper,right:] = 0
 
     return mask
 
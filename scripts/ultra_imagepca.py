@@ -13,10 +13,13 @@ from __future__ import absolute_import, division, print_function
 
 import os, sys, re
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import audiolabel
 import numpy as np
-from scipy import ndimage
+import pandas as pd
 import matplotlib.pyplot as plt
+from imgphon.ultrasound import batch_median
 from ultratils.exp import Exp
 from ultratils.utils import is_white_bpr
 from ultratils.utils import is_frozen_bpr
@@ -25,7 +28,7 @@ import time
 
 # for PCA business
 from sklearn import decomposition
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
 
 start = time.time()
 
@@ -69,28 +72,34 @@ L_bool = np.zeros([exp_length], dtype=bool)
 R_bool = np.zeros([exp_length], dtype=bool)
 ER_bool = np.zeros([exp_length], dtype=bool)
 
-for idx, st in enumerate(e.acquisitions):
-    with open (st.abs_stim_file, "r") as mystim:
-        key = mystim.read().rstrip('\n')
-        if key == "bolus":
-            continue
-        if key.startswith("A "):
-            key = key.split(" ")[1]
-        # all keys containing R or L will be in the baseline (English) set.
-        if "R" in key:
-            if key == "BURR" or key == "PER":
-                ER_bool[idx] = True
-            else:
-                R_bool[idx] = True
-        # if key == "POLE": # TODO could be changed to include more vowel contexts
-        if "L" in key:
-            L_bool[idx] = True
+def read_stim(acq):
+    """Return the stimulus key from an acquisition's stim file."""
+    with open(acq.abs_stim_file, "r") as mystim:
+        return(mystim.read().rstrip('\n'))
+
+# stim files are tiny, so reading them is dominated by open() latency; read them concurrently.
+with ThreadPoolExecutor(max_workers=32) as executor:
+    keys = list(executor.map(read_stim, e.acquisitions))
+
+for idx, key in enumerate(keys):
+    if key == "bolus":
+        continue
+    if key.startswith("A "):
+        key = key.split(" ")[1]
+    # all keys containing R or L will be in the baseline (English) set.
+    if "R" in key:
+        if key == "BURR" or key == "PER":
+            ER_bool[idx] = True
+        else:
+            R_bool[idx] = True
+    # if key == "POLE": # TODO could be changed to include more vowel contexts
+    if "L" in key:
+        L_bool[idx] = True
 
 pc_out = os.path.join(e.expdir,"pc_out.txt")
 exp_var_out = os.path.join(e.expdir,"exp_var_out.txt")
 logfile = os.path.join(e.expdir,"issues_log.txt")
 
-frames = None
 threshhold = 0.020 # threshhold value in s for moving away from acoustic midpoint measure
 phase = []
 trial = []
@@ -98,18 +107,19 @@ phone = []
 tstamp = []
 
 # adjust shape of array for pre-converted BPR images if desired
+first_frame = e.acquisitions[0].image_reader.get_frame(0)
 if args.convert:
-    conv_frame = e.acquisitions[0].image_reader.get_frame(0)
-    conv_img = test.image_converter.as_bmp(conv_frame)
+    frame_shape = e.acquisitions[0].image_converter.as_bmp(first_frame).shape
+else:
+    frame_shape = first_frame.shape
 
-# # # # Comb the experiment object for data, and output numpy arrays to run PCs on. # # # #
-for idx,a in enumerate(e.acquisitions):
+# midpoint frames are cached on disk rather than held in memory; recorded marks those actually filled
+frames = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=(exp_length,) + tuple(frame_shape))
+recorded = np.zeros([exp_length], dtype=bool)
 
-    # a.gather()
-    print("Now working on {}".format(a.timestamp))
-    
-    # setup for PC and audio
-    wav = a.abs_ch1_audio_file
+def extract_target(acq):
+    """Return the target segment label and its word's text from an acquisition's TextGrid."""
+    wav = acq.abs_ch1_audio_file
     tg = os.path.splitext(wav)[0] + '.TextGrid'
     pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
     v,m = pm.tier('phone').search(vre, return_match=True)[-1] # return last V = target V
@@ -122,17 +132,44 @@ for idx,a in enumerate(e.acquisitions):
     if (pm.tier('phone').prev(v).text == "L") or (pm.tier('phone').prev(v).text == "R"):
         v = pm.tier('phone').prev(v)
 
+    return(v, myword)
+
+# TextGrids are read and searched in the background while the main loop handles frames;
+# errors surface only for acquisitions whose targets are actually used.
+label_executor = ThreadPoolExecutor(max_workers=32)
+targets = [label_executor.submit(extract_target, a) for a in e.acquisitions]
+
+# # # # Comb the experiment object for data, and output numpy arrays to run PCs on. # # # #
+for idx,a in enumerate(e.acquisitions):
+
+    # a.gather()
+    print("Now working on {}".format(a.timestamp))
+
     # collect PC information.
-    if frames is None:
-        if args.convert:
-            frames = np.empty([len(e.acquisitions)] + list(conv_img.shape))
-        else:
-            frames = np.empty([len(e.acquisitions)] + list(a.image_reader.get_frame(0).shape)) * np.nan
-    
     phase.append(a.runvars.phase)
     trial.append(idx)
     tstamp.append(a.timestamp)
 
+    # image checking and exclusion from set if stuck or "white", before any label or frame reading.
+    # a white BPR is not also checked for freezing.
+    # TODO initial frame comparisons occasionally catch nothing??
+    if is_white_bpr(a.abs_image_file):
+        bpr_issue = "White fan of death in BPR file"
+    elif is_frozen_bpr(a.abs_image_file):
+        bpr_issue = "Frozen BPR file"
+    else:
+        bpr_issue = None
+
+    if bpr_issue is not None:
+        with open(logfile, "a") as log:
+            log.write("SKIPPING acq {:}\t{:}\n".format(a.timestamp, bpr_issue))
+        phone.append("") # placeholder; acquisition is dropped as unrecorded
+        targets[idx].cancel()
+        continue
+    
+    # setup for PC and audio
+    v, myword = targets[idx].result()
+
     # HOOF fix - CMUdict has UW1 for the word
     if myword == "HOOF":
         phone.append("UH1")
@@ -144,19 +181,6 @@ for idx,a in enumerate(e.acquisitions):
     else:
         mid, mid_lab, mid_repl = a.frame_at(v.center,missing_val="prev")
 
-        
-    # image checking and exclusion from set if stuck or "white"
-    # TODO initial frame comparisons occasionally catch nothing??
-    if is_white_bpr(a.abs_image_file):
-        with open(logfile, "a") as log:
-            log.write("SKIPPING acq {:} ({:})\tWhite fan of death in BPR file\n".format(a.timestamp, v))
-        continue
-
-    if is_frozen_bpr(a.abs_image_file):
-        with open(logfile, "a") as log:
-            log.write("SKIPPING acq {:} ({:})\tFrozen BPR file\n".format(a.timestamp, v))
-        continue
-
     # checking that the midpoint frame was actually recorded; excludes acquisition if closest available frame is too far away
     if mid is None:
         if mid_repl is None:
@@ -171,93 +195,77 @@ for idx,a in enumerate(e.acquisitions):
             else:
                 mid = mid_repl
                 
-    # TODO log compression or thresholding brightening algorithm?
-    mid = ndimage.median_filter(mid, 5) # comment out if no denoising median filter desired
     frames[idx,:,:] = mid
+    recorded[idx] = True
+
+label_executor.shutdown()
 
 # # # generate PCA objects over collected arrays # # #
 
 # subset data to remove unwanted subsets of trials before running PCA. 
 # By default, the script will filter out all L, R, ER words. using "include_" flags includes relevant set.
 
-def make_removal_bool(*bools):
-    """Pass in some number of boolean arrays that pick out as True the segments that want to be removed.
-    Return a single boolean array that marks these segments as False."""
-    return(np.invert([np.any(f) for f in zip(*bools)]))
-
-NAN_bool = np.isnan(frames).any(axis=(1,2))
+NAN_bool = ~recorded
 
 # subset based on values in args and whether or not NAN.
-if args.include_r:
-    if args.include_l:
-        if args.include_er:
-            # remove only NANs
-            mybool = make_removal_bool(NAN_bool)
-        else:
-            # remove ER (and NANs ...)
-            mybool = make_removal_bool(ER_bool, NAN_bool)
-    else:
-        if args.include_er:
-            # remove L
-            mybool = make_removal_bool(L_bool, NAN_bool)
-        else:
-            # remove L and ER
-            mybool = make_removal_bool(L_bool, ER_bool, NAN_bool)
-else:
-    if args.include_l:
-        if args.include_er:
-            # remove R
-            mybool = make_removal_bool(R_bool, NAN_bool)
-        else:
-            # remove R and ER
-            mybool = make_removal_bool(R_bool, ER_bool, NAN_bool)
-    else:
-        if args.include_er:
-            # remove L and R
-            mybool = make_removal_bool(R_bool, L_bool, NAN_bool)
-        else:
-            # remove ER, L, and R
-            mybool = make_removal_bool(R_bool, L_bool, ER_bool, NAN_bool)
+remove = NAN_bool.copy()
+if not args.include_r:
+    remove |= R_bool
+if not args.include_l:
+    remove |= L_bool
+if not args.include_er:
+    remove |= ER_bool
+mybool = ~remove
 
 def subset(mylist,mybool):
     """Remove values from a list that are False for some bool."""
-    myarray = np.array(mylist)
-    return(np.squeeze(myarray.take(np.where(mybool),axis=0)))
+    return(np.asarray(mylist)[mybool])
 
 # remove any indices for all objects generated above where frames have NaN values (due to skipping or otherwise)
-kept_frames = subset(frames,mybool)
 kept_phone = subset(phone,mybool)
 kept_trial = subset(trial,mybool)
 kept_phase = subset(phase,mybool)
 kept_tstamp = subset(tstamp,mybool)
 
-# the PCA is run over the kept_frames array.
+# the PCA is run over the kept frames, streamed from the cache in batches.
+# batches of at least batch_size frames (the last absorbs any remainder), so each has enough samples for partial_fit.
+batch_size = 64
+kept_idx = np.flatnonzero(mybool)
+batches = np.array_split(kept_idx, max(1, len(kept_idx) // batch_size))
+n_pixels = frame_shape[0] * frame_shape[1]
 
 # get component output count from args
 n_components = args.num_components
-pca = PCA(n_components=n_components)
-frames_reshaped = kept_frames.reshape([kept_frames.shape[0], kept_frames.shape[1]*kept_frames.shape[2]])
+pca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+
+# TODO log compression or thresholding brightening algorithm?
+# denoising median filter, applied a batch at a time; comment out if not desired.
+# filtered frames are written back to the cache for scoring below.
+for batch_idx in batches:
+    batch = batch_median(frames[batch_idx], 5)
+    frames[batch_idx] = batch
+    pca.partial_fit(batch.reshape([len(batch_idx), n_pixels]))
 
-pca.fit(frames_reshaped)
-analysis = pca.transform(frames_reshaped)
+analysis = np.vstack([pca.transform(frames[batch_idx].reshape([len(batch_idx), n_pixels])) for batch_idx in batches])
 
 # save trial-by-trial PC scores to pc_out
 subj_dir = os.path.split(e.abspath)[1] # strip subject info from dir name
 subj_pref = subj_dir.split('-')[0]
-subj = np.array([subj_pref] * analysis.shape[0]) # make array of same length as PC score data
 
-meta_headers = ["subj","phase","trial","timestamp","phone"]
 pc_labels = ["pc"+str(i+1) for i in range(0,n_components)] # determine number of PC columns in output; changes w.r.t. n_components
-headers = meta_headers + pc_labels
 
-d = np.row_stack((headers,np.column_stack((subj,kept_phase,kept_trial,kept_tstamp,kept_phone,analysis))))
-np.savetxt(pc_out, d, fmt="%s", delimiter =',')
+# metadata columns go in front of the PC scores; subj is broadcast to every row
+d = pd.DataFrame(analysis, columns=pc_labels)
+d.insert(0, "phone", kept_phone)
+d.insert(0, "timestamp", kept_tstamp)
+d.insert(0, "trial", kept_trial)
+d.insert(0, "phase", kept_phase)
+d.insert(0, "subj", subj_pref)
+d.to_csv(pc_out, index=False)
 
 # save pct variance explained to exp_var_out
-pve_headers = ["subj","pc","pct_exp"]
-pve_subj = np.array([subj_pref] * n_components) # make another array of same length as number of PCs
-d_pve = np.row_stack((pve_headers,np.column_stack((pve_subj,pc_labels,pca.explained_variance_ratio_))))
-np.savetxt(exp_var_out, d_pve, fmt="%s", delimiter = ',')
+d_pve = pd.DataFrame({"subj": subj_pref, "pc": pc_labels, "pct_exp": pca.explained_variance_ratio_})
+d_pve.to_csv(exp_var_out, index=False)
 
 print("Data saved. Explained variance ratio of PCs: %s" % str(pca.explained_variance_ratio_))
 
@@ -266,21 +274,33 @@ print("Data saved. Explained variance ratio of PCs: %s" % str(pca.explained_vari
 
 if args.visualize:
     image_shape = (416,69)
+    converter = e.acquisitions[0].image_converter # converter from any frame will work; here we use the first
+
+    # a single figure is reused for all components; only the image data and title change between saves
+    fig, ax = plt.subplots()
+    pc_img = None
 
     for n in range(0,n_components):
         d = pca.components_[n].reshape(image_shape)
-        mag = np.max(d) - np.min(d)
-        d = (d-np.min(d))/mag*255
-        pcn = np.flipud(e.acquisitions[0].image_converter.as_bmp(d)) # converter from any frame will work; here we use the first
+        d_min = np.min(d)
+        mag = np.max(d) - d_min
+        d = (d-d_min)/mag*255
+        pcn = np.flipud(converter.as_bmp(d))
 
         if args.flop:
             pcn = np.fliplr(pcn)
 
-        plt.title("PC{:} min/max loadings, Part. {:}".format((n+1), e.expdir))
-        plt.imshow(pcn, cmap="Greys_r") 
+        if pc_img is None:
+            pc_img = ax.imshow(pcn, cmap="Greys_r")
+        else:
+            pc_img.set_data(pcn)
+            pc_img.autoscale()
+        ax.set_title("PC{:} min/max loadings, Part. {:}".format((n+1), e.expdir))
         file_ending = "subj{:}-pc{:}.pdf".format(e.expdir, (n+1)) # TODO figure out where this goes.
         savepath = os.path.join(e.expdir,file_ending)
-        plt.savefig(savepath)
+        fig.savefig(savepath)
+
+    plt.close(fig)
 
 end = time.time()
 